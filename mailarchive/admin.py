@@ -5,19 +5,29 @@ from __future__ import print_function
 import imaplib
 import datetime
 import os
+import re
+import shutil
+import sys
 
 from trac.admin import IAdminCommandProvider
 from trac.attachment import Attachment
+from trac.config import PathOption
 from trac.core import Component, TracError, implements
 from trac.db.api import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
-from trac.util.text import exception_to_unicode
+from trac.util.datefmt import parse_date, to_utimestamp, utc
 from trac.util.translation import _
 
-from mailarchive.model import ArchivedMail, SCHEMA, normalized_filename
+from mailarchive.dedup import DuplicateFilter
+from mailarchive.export import EXPORT_FORMATS, export_mails
+from mailarchive.maintenance import AttachmentMaintenance
+from mailarchive.model import (ArchivedMail, COLD_TABLE, HOT_TABLE, SCHEMA,
+                               message_digest, normalized_body)
 
 PLUGIN_NAME = 'MailArchivePlugin'
-PLUGIN_VERSION = 2
+PLUGIN_VERSION = 5
+
+UID_RE = re.compile(r'\bUID (\d+)')
 
 
 def to_imap_date(d):
@@ -29,15 +39,65 @@ class MailArchiveAdmin(Component):
 
     implements(IEnvironmentSetupParticipant, IAdminCommandProvider)
 
+    cold_attachments_dir = PathOption('mailarchive', 'cold_attachments_dir', '',
+        """Directory the attachment files of mails in the cold tier are moved
+        to by `mailarchive tier`. A symbolic link is left in the attachments
+        directory so they can still be downloaded. If empty, the files are
+        not moved.""")
+
     # IAdminCommandProvider methods
 
     def get_admin_commands(self):
         yield ('mailarchive fetch', '<host> <username> <password>',
                'Download mails to the archive (via IMAP4)',
                None, self._do_fetch)
-        yield ('mailarchive fix-attachment-filenames', '',
-               'Normalize old broken attachment filenames.',
+        yield ('mailarchive fix-attachment-filenames', '[--dry-run] [--restart]',
+               """Normalize old broken attachment filenames.
+
+               Attachments are processed in batches, each renamed in a single
+               transaction. An interrupted run resumes where it stopped,
+               unless `--restart` is given. With `--dry-run` the attachments
+               that would be renamed are only listed.
+               """,
                None, self._do_fix_attachment_filenames)
+        yield ('mailarchive verify-attachments', '[--restart]',
+               """Check attachment files of archived mails
+
+               Reports files that are missing, have a different size than
+               recorded, or are not referenced by any attachment, in the
+               attachments directory and in `cold_attachments_dir`. An
+               interrupted run resumes where it stopped, unless `--restart`
+               is given; orphaned files are then not reported.
+               """,
+               None, self._do_verify_attachments)
+        yield ('mailarchive export',
+               '<mbox|jsonl> [--attachments] [since] [until] [filter]',
+               """Export archived mails to standard output
+
+               Mails are streamed in date order. `since` and `until` limit
+               the date range (`until` is exclusive), an empty string leaves
+               that end open. `filter` works like the filter of the mail
+               archive list. With `--attachments` the attachments are
+               included as MIME parts (mbox) or base64 strings (jsonl).
+               """,
+               self._complete_export, self._do_export)
+        yield ('mailarchive dedup', '[--dry-run]',
+               """Merge archived mails with the same content
+
+               For each set of duplicates the oldest mail is kept. Mails
+               with a different body are left alone. The
+               comments and the attachments with other filenames of the
+               duplicates are added to it, then the duplicates are deleted.
+               """,
+               None, self._do_dedup)
+        yield ('mailarchive tier', '<days>',
+               """Move mails older than the given number of days to the cold tier
+
+               Mails in the cold tier are only listed, counted and searched
+               when older mail is explicitly requested. Mails in the cold tier
+               that are newer than the given number of days are moved back.
+               """,
+               None, self._do_tier)
 
     def _do_fetch(self, host, username, password):
         imap_conn = imaplib.IMAP4_SSL(host)
@@ -47,72 +107,237 @@ class MailArchiveAdmin(Component):
         # Search for mails since yesterday
         yesterday = to_imap_date(datetime.date.today() - datetime.timedelta(1))
         typ, data = imap_conn.uid('search', None, '(OR UNSEEN (SINCE %s))' % (yesterday,))
-        for uid in data[0].split():
-
-            # No duplicates
-            if ArchivedMail.select_by_id(self.env, uid) is not None:
-                print("Skipping mail with UID %s" % (uid,))
-                continue
-
-            typ, data = imap_conn.uid('fetch', uid, '(RFC822)')
-            source = data[0][1]
-            mail, msg = ArchivedMail.parse(uid, source)
-            ArchivedMail.add(self.env, mail)
-            ArchivedMail.storeattachments(self.env, mail, msg)
+        uids = data[0].split()
+        batch_size = 100
+        duplicates = DuplicateFilter(self.env)
+        for i in range(0, len(uids), batch_size):
+            batch = uids[i:i + batch_size]
+
+            # No duplicates, neither by UID nor by content
+            existing = ArchivedMail.select_existing_ids(self.env, batch)
+            headers = self._fetch_headers(imap_conn, [uid for uid in batch
+                                                      if uid not in existing])
+            digests = dict((uid, message_digest(header))
+                           for uid, header in headers.items())
+            new_digests = duplicates.select_new(digest for digest in digests.values()
+                                                if digest is not None)
+
+            for uid in batch:
+                if uid in existing:
+                    print("Skipping mail with UID %s" % (uid,))
+                    continue
+                if uid not in digests:
+                    self.env.log.warning("No headers fetched for UID %s, fetching "
+                                         "the whole mail", uid)
+                digest = digests.get(uid)
+
+                typ, data = imap_conn.uid('fetch', uid, '(RFC822)')
+                if not data or not isinstance(data[0], tuple):
+                    print("Could not fetch mail with UID %s" % (uid,))
+                    continue
+                source = data[0][1]
+                mail, msg = ArchivedMail.parse(uid, source)
+                if digest in new_digests:
+                    # Certainly not archived yet
+                    new_digests.discard(digest)
+                elif self._is_duplicate(duplicates, mail):
+                    print("Skipping duplicate mail with UID %s" % (uid,))
+                    continue
+                ArchivedMail.add(self.env, mail)
+                ArchivedMail.storeattachments(self.env, mail, msg)
+                duplicates.add(mail.digest)
         imap_conn.close()
         imap_conn.logout()
 
-    def _do_fix_attachment_filenames(self):
+    def _complete_export(self, args):
+        if len(args) == 1:
+            return list(EXPORT_FORMATS)
+        if len(args) == 2:
+            return ['--attachments']
+
+    def _do_export(self, format, *args):
+        if format not in EXPORT_FORMATS:
+            raise TracError(_("Unknown export format '%(format)s'",
+                              format=format))
+        args = list(args)
+        with_attachments = '--attachments' in args
+        if with_attachments:
+            args.remove('--attachments')
+        if len(args) > 3:
+            raise TracError(_("Too many arguments"))
+        since, until, filter = (args + [''] * 3)[:3]
+        start = parse_date(since, utc, hint='datetime') if since else None
+        end = parse_date(until, utc, hint='datetime') if until else None
+
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        for chunk in export_mails(self.env, format, filter, start, end,
+                                  with_attachments):
+            out.write(chunk)
+        out.flush()
+
+    def _is_duplicate(self, duplicates, mail):
+        """Return whether an archived mail has the same digest and body as
+        `mail`. This is the rule `mailarchive dedup` merges by, too."""
+        if duplicates.select_new([mail.digest]):
+            return False
+        body = normalized_body(mail.body)
+        return any(normalized_body(archived.body) == body for archived in
+                   ArchivedMail.select_by_digest(self.env, mail.digest))
+
+    def _fetch_headers(self, imap_conn, uids):
+        """Return a dict mapping the given UIDs to their header blocks,
+        fetched with a single command."""
+        if not uids:
+            return {}
+        typ, data = imap_conn.uid('fetch', ','.join(uids), '(BODY.PEEK[HEADER])')
+        headers = {}
+        pending = None
+        for item in data:
+            # The UID is reported either before or after the header literal
+            if isinstance(item, tuple):
+                match = UID_RE.search(item[0])
+                if match:
+                    headers[match.group(1)] = item[1]
+                    pending = None
+                else:
+                    pending = item[1]
+            elif item and pending is not None:
+                match = UID_RE.search(item)
+                if match:
+                    headers[match.group(1)] = pending
+                pending = None
+        return headers
+
+    def _do_dedup(self, *args):
+        dry_run, = self._parse_maintenance_args(args, ('--dry-run',))
+        count = 0
+        for digest in ArchivedMail.select_duplicate_digests(self.env):
+            mails = ArchivedMail.select_by_digest(self.env, digest)
+            keep = mails[0]
+            for mail in mails[1:]:
+                if normalized_body(mail.body) != normalized_body(keep.body):
+                    print("Not merging mail %s into %s: the bodies differ"
+                          % (mail.id, keep.id))
+                    continue
+                print("Merging mail %s into %s" % (mail.id, keep.id))
+                if not dry_run:
+                    self._merge_mail(keep, mail)
+                count += 1
+        if dry_run:
+            print("%d duplicate mails would be merged" % (count,))
+        else:
+            print("%d duplicate mails merged" % (count,))
+
+    def _merge_mail(self, keep, mail):
         realm = 'mailarchive'
-        for mail in ArchivedMail.select_all(self.env):
-            for attachment in Attachment.select(self.env, realm, mail.id):
-                new_filename = normalized_filename(attachment.filename)
-                if new_filename != attachment.filename:
-                    self._rename_attachment(attachment, new_filename)
-
-    def _rename_attachment(self, attachment, new_filename):
-        self.env.log.info("Renaming attachment of %s:%s from '%s' to '%s'",
-                          attachment.parent_realm, attachment.parent_id,
-                          attachment.filename, new_filename)
-        new_path = attachment._get_path(self.env.attachments_dir,
-                                        attachment.parent_realm,
-                                        attachment.parent_id, new_filename)
-
-        # Make sure the path to the attachment is inside the environment
-        # attachments directory
-        commonprefix = os.path.commonprefix([self.env.attachments_dir,
-                                             new_path])
-        if commonprefix != self.env.attachments_dir:
-            raise TracError(_('Cannot rename attachment "%(att)s" as '
-                              '%(new)s is invalid',
-                              att=attachment.filename, new=new_filename))
-
-        if os.path.exists(new_path):
-            raise TracError(_('Cannot rename attachment "%(att)s" to %(new)s '
-                              'as it already exists',
-                              att=attachment.filename, new=new_filename))
-        with self.env.db_transaction as db:
-            db("""UPDATE attachment SET filename=%s
-                  WHERE type=%s AND id=%s AND filename=%s
-                  """, (new_filename, attachment.parent_realm,
-                        attachment.parent_id, attachment.filename))
-            dirname = os.path.dirname(new_path)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            path = attachment.path
-            if os.path.isfile(path):
-                try:
-                    os.rename(path, new_path)
-                except OSError as e:
-                    self.env.log.error("Failed to move attachment file %s: %s",
-                                       path,
-                                       exception_to_unicode(e, traceback=True))
-                    raise TracError(_("Could not rename attachment %(name)s",
-                                      name=attachment.filename))
-
-        attachment.filename = new_filename
-
-        self.env.log.info("Attachment renamed: %s", new_filename)
+        with self.env.db_transaction:
+            if mail.comment and mail.comment not in (keep.comment or ''):
+                keep.comment = '\n'.join(c for c in (keep.comment, mail.comment) if c)
+                ArchivedMail.update_comment(self.env, keep.id, keep.comment)
+            filenames = set(attachment.filename for attachment in
+                            Attachment.select(self.env, realm, keep.id))
+            for attachment in list(Attachment.select(self.env, realm, mail.id)):
+                if attachment.filename in filenames:
+                    self._delete_attachment(attachment)
+                else:
+                    attachment.move(new_id=keep.id)
+                    filenames.add(attachment.filename)
+            ArchivedMail.delete(self.env, mail)
+
+    def _delete_attachment(self, attachment):
+        # The file of an attachment in the cold tier is only linked from the
+        # attachments directory, delete the linked file too
+        path = attachment.path
+        target = os.path.realpath(path) if os.path.islink(path) else None
+        attachment.delete()
+        if target and os.path.isfile(target):
+            os.remove(target)
+
+    def _do_tier(self, days):
+        try:
+            days = int(days)
+        except ValueError:
+            raise TracError(_("Invalid number of days '%(days)s'", days=days))
+        cutoff = datetime.datetime.now(utc) - datetime.timedelta(days)
+        moved = self._move_tier(cutoff, cold=True)
+        restored = self._move_tier(cutoff, cold=False)
+        print("Moved %d mails to the cold tier, %d mails back to the hot tier"
+              % (moved, restored))
+
+    def _move_tier(self, cutoff, cold, batch_size=500):
+        table, op = (HOT_TABLE, '<') if cold else (COLD_TABLE, '>=')
+        count = 0
+        while True:
+            ids = [id for id, in self.env.db_query("""
+                    SELECT id FROM %s WHERE date%s%%s ORDER BY date LIMIT %d
+                    """ % (table, op, batch_size), (to_utimestamp(cutoff),))]
+            if not ids:
+                return count
+            with self.env.db_transaction:
+                ArchivedMail.move_to_tier(self.env, ids, cold)
+                self._move_attachment_files(ids, cold)
+            count += len(ids)
+
+    def _move_attachment_files(self, ids, cold):
+        cold_dir = self.cold_attachments_dir
+        if not cold_dir:
+            return
+        for attachments in ArchivedMail.select_attachments(self.env, ids).values():
+            for attachment in attachments:
+                hot_path = attachment.path
+                cold_path = os.path.join(cold_dir, os.path.relpath(hot_path, self.env.attachments_dir))
+                if cold and os.path.isfile(hot_path) and not os.path.islink(hot_path):
+                    self.env.log.debug("Moving attachment file %s to %s", hot_path, cold_path)
+                    if not os.path.exists(os.path.dirname(cold_path)):
+                        os.makedirs(os.path.dirname(cold_path))
+                    shutil.move(hot_path, cold_path)
+                    os.symlink(cold_path, hot_path)
+                elif not cold and os.path.islink(hot_path):
+                    # The link may have been renamed or moved to another mail
+                    # since, so move the file it links to
+                    target = os.path.realpath(hot_path)
+                    if not os.path.isfile(target):
+                        self.env.log.warning("Attachment file %s links to missing %s",
+                                             hot_path, target)
+                        continue
+                    self.env.log.debug("Moving attachment file %s to %s", target, hot_path)
+                    os.remove(hot_path)
+                    shutil.move(target, hot_path)
+
+    def _do_fix_attachment_filenames(self, *args):
+        dry_run, restart = self._parse_maintenance_args(args, ('--dry-run', '--restart'))
+        engine = AttachmentMaintenance(self.env, dry_run=dry_run)
+        count = skipped = 0
+        for id, filename, new_filename, problem in engine.fix_filenames(resume=not restart):
+            if problem:
+                print("%s:%s: skipping '%s' -> '%s': %s"
+                      % (engine.realm, id, filename, new_filename, problem))
+                skipped += 1
+            else:
+                print("%s:%s: '%s' -> '%s'" % (engine.realm, id, filename, new_filename))
+                count += 1
+        if dry_run:
+            print("%d attachments would be renamed, %d skipped" % (count, skipped))
+        else:
+            print("%d attachments renamed, %d skipped" % (count, skipped))
+
+    def _do_verify_attachments(self, *args):
+        restart, = self._parse_maintenance_args(args, ('--restart',))
+        engine = AttachmentMaintenance(self.env, cold_dir=self.cold_attachments_dir)
+        count = 0
+        for problem, id, filename, path in engine.verify(resume=not restart):
+            if problem == 'orphaned':
+                print("orphaned: %s" % (path,))
+            else:
+                print("%s: %s:%s '%s' (%s)" % (problem, engine.realm, id, filename, path))
+            count += 1
+        print("%d problems found" % (count,))
+
+    def _parse_maintenance_args(self, args, flags):
+        for arg in args:
+            if arg not in flags:
+                raise TracError(_("Unknown argument '%(arg)s'", arg=arg))
+        return tuple(flag in args for flag in flags)
 
     # IEnvironmentSetupParticipant
 
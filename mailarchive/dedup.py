@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+from mailarchive.model import ArchivedMail
+
+
+class BloomFilter(object):
+    """A Bloom filter of hex digests, as returned by `message_digest`.
+
+    Membership tests may return false positives with probability
+    `error_rate`, but never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest):
+        # The digest is already a hash, so derive the positions from two of
+        # its parts (double hashing) instead of hashing it again.
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(digest))
+
+
+class DuplicateFilter(object):
+    """Tells which incoming messages are already archived.
+
+    The digests of all archived mails are loaded into a `BloomFilter` once,
+    so most new messages are accepted without a query. Only possible
+    duplicates are looked up in the database, in one query per batch.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        count = ArchivedMail.count_all(env, include_cold=True)
+        self.bloom = BloomFilter(max(2 * count, 10000))
+        for digests in ArchivedMail.select_digest_batches(env):
+            for digest in digests:
+                self.bloom.add(digest)
+
+    def select_new(self, digests):
+        """Return the set of the given digests that are not archived yet."""
+        digests = set(digests)
+        candidates = set(digest for digest in digests if digest in self.bloom)
+        return digests - ArchivedMail.select_existing_digests(self.env, candidates)
+
+    def add(self, digest):
+        """Record the digest of a newly archived message."""
+        self.bloom.add(digest)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import base64
+from email.encoders import encode_base64
+from email.generator import Generator
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import HeaderParser
+from email.utils import getaddresses
+from io import BytesIO
+import json
+import mimetypes
+
+from trac.resource import ResourceNotFound
+from trac.util.text import exception_to_unicode
+
+from mailarchive.model import ArchivedMail
+
+EXPORT_FORMATS = {
+    'mbox': 'application/mbox',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Headers describing the original MIME structure, which is rebuilt on export.
+MIME_HEADERS = ('content-type', 'content-transfer-encoding', 'mime-version')
+
+
+def _read_attachment(attachment):
+    """Return the content of the attachment, or `None` if its file can not
+    be read, so one missing file does not abort the whole export."""
+    try:
+        with attachment.open() as fd:
+            return fd.read()
+    except (ResourceNotFound, IOError) as e:
+        attachment.env.log.warning("Can not export attachment %s of mail %s: %s",
+                                   attachment.filename, attachment.parent_id,
+                                   exception_to_unicode(e))
+        return None
+
+def _envelope_sender(mail):
+    addresses = [addr for name, addr in getaddresses([mail.fromheader or '']) if addr]
+    return addresses[0] if addresses else 'MAILER-DAEMON'
+
+def mail_to_message(mail, attachments=None):
+    """Rebuild an `email.message.Message` from an archived mail.
+
+    The original headers are kept, except those describing the MIME
+    structure. If `attachments` is given, they are added as base64 encoded
+    parts of a `multipart/mixed` message.
+    """
+    text = MIMEText((mail.body or u'').encode('utf-8'), 'plain', 'utf-8')
+    if attachments:
+        msg = MIMEMultipart()
+        msg.attach(text)
+        for attachment in attachments:
+            content = _read_attachment(attachment)
+            if content is None:
+                continue
+            mimetype = mimetypes.guess_type(attachment.filename)[0] or 'application/octet-stream'
+            part = MIMEBase(*mimetype.split('/', 1))
+            part.set_payload(content)
+            encode_base64(part)
+            part.add_header('Content-Disposition', 'attachment',
+                            filename=('utf-8', '', attachment.filename.encode('utf-8')))
+            msg.attach(part)
+    else:
+        msg = text
+
+    # Raw 8-bit header bytes were stored as U+FFFD, write them as '?' so the
+    # headers stay ASCII
+    headers = HeaderParser().parsestr((mail.allheaders or u'').encode('ascii', 'replace'))
+    for name, value in headers.items():
+        if name.lower() not in MIME_HEADERS:
+            msg[name] = value
+    msg['X-MailArchive-Id'] = str(mail.id)
+    return msg
+
+def mail_to_mbox(mail, attachments=None):
+    """Return an mbox (mboxo) entry for the archived mail as a byte string."""
+    out = BytesIO()
+    out.write(b'From %s %s\n' % (_envelope_sender(mail).encode('ascii', 'replace'),
+                                 mail.date.strftime('%a %b %d %H:%M:%S %Y')))
+    Generator(out, mangle_from_=True).flatten(mail_to_message(mail, attachments))
+    out.write(b'\n\n')
+    return out.getvalue()
+
+def mail_to_json(mail, attachments=None):
+    """Return a JSON Lines entry for the archived mail.
+
+    The `attachments` key is only present if `attachments` is not `None`.
+    The `content` of an attachment whose file can not be read is `None`.
+    """
+    data = {
+        'id': mail.id,
+        'subject': mail.subject,
+        'from': mail.fromheader,
+        'to': mail.toheader,
+        'date': mail.date.isoformat(),
+        'headers': mail.allheaders,
+        'body': mail.body,
+        'comment': mail.comment,
+    }
+    if attachments is not None:
+        data['attachments'] = []
+        for attachment in attachments:
+            content = _read_attachment(attachment)
+            data['attachments'].append({
+                'filename': attachment.filename,
+                'description': attachment.description,
+                'size': attachment.size,
+                'content': None if content is None else base64.b64encode(content).decode('ascii'),
+            })
+    return json.dumps(data, sort_keys=True) + '\n'
+
+def export_mails(env, format, filter=None, start=None, end=None,
+                 with_attachments=False, batch_size=100):
+    """Yield the matching archived mails as `str` chunks in the given format.
+
+    Mails are read in keyset batches, so memory use stays constant and the
+    first chunk is available without scanning the whole archive. Both the
+    hot and the cold tier are exported.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format %r" % (format,))
+    formatter = mail_to_mbox if format == 'mbox' else mail_to_json
+    batches = ArchivedMail.select_filtered_batches(env, filter, start, end,
+                                                   batch_size, include_cold=True)
+    for mails in batches:
+        attachments = {}
+        if with_attachments:
+            attachments = ArchivedMail.select_attachments(env, [mail.id for mail in mails])
+        for mail in mails:
+            chunk = formatter(mail, attachments.get(mail.id) if with_attachments else None)
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            yield chunk
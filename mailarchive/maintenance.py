@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+
+from trac.attachment import Attachment
+from trac.core import TracError
+from trac.util.text import exception_to_unicode
+from trac.util.translation import _
+
+from mailarchive.model import normalized_filename
+
+
+class AttachmentMaintenance(object):
+    """Maintenance operations on the attachments of archived mails.
+
+    The `attachment` table is read in keyset batches ordered by
+    `(id, filename)`, so memory use does not depend on the number of
+    attachments. After each batch a checkpoint is stored in the `system`
+    table, so an interrupted operation resumes where it stopped.
+    """
+
+    realm = 'mailarchive'
+
+    # Trac groups attachment directories by the first 3 hex digits of the
+    # hash of the parent id
+    buckets = 0x1000
+
+    def __init__(self, env, dry_run=False, batch_size=1000, cold_dir=None,
+                 orphan_batch_size=500000):
+        self.env = env
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.cold_dir = cold_dir
+        self.orphan_batch_size = orphan_batch_size
+
+    def fix_filenames(self, resume=True):
+        """Normalize old broken attachment filenames.
+
+        Yields `(id, filename, new_filename, problem)` for each attachment
+        that needs a new filename. `problem` is `None` if the attachment is
+        (or with `dry_run` would be) renamed, otherwise it tells why the
+        attachment is skipped. All renames of a batch are done in one
+        transaction.
+        """
+        operation = 'fix-filenames'
+        for rows in self._select_batches(operation, resume):
+            renames = []
+            skipped = []
+            new_paths = set()
+            for id, filename, size in rows:
+                new_filename = normalized_filename(filename)
+                if new_filename == filename:
+                    continue
+                problem = self._check_rename(id, filename, new_filename, new_paths)
+                if problem:
+                    skipped.append((id, filename, new_filename, problem))
+                else:
+                    renames.append((id, filename, new_filename))
+                    new_paths.add(self._get_path(id, new_filename))
+            if not self.dry_run:
+                self._rename_batch(operation, renames, rows[-1][:2])
+            for id, filename, new_filename in renames:
+                yield id, filename, new_filename, None
+            for conflict in skipped:
+                yield conflict
+        self._clear_checkpoint(operation)
+
+    def verify(self, resume=True):
+        """Check the attachment files against the `attachment` table.
+
+        Yields `(problem, id, filename, path)` tuples, where `problem` is
+        `'missing'`, `'size'` or `'orphaned'`. Orphaned files are only
+        reported when the whole table was checked in this run, see
+        `find_orphans`.
+        """
+        operation = 'verify'
+        complete = not (resume and self._get_checkpoint(operation))
+        for rows in self._select_batches(operation, resume):
+            for id, filename, size in rows:
+                path = self._get_path(id, filename)
+                if not os.path.isfile(path):
+                    yield 'missing', id, filename, path
+                elif size is not None and os.path.getsize(path) != size:
+                    yield 'size', id, filename, path
+            if not self.dry_run:
+                with self.env.db_transaction as db:
+                    self._set_checkpoint(db, operation, rows[-1][:2])
+
+        if complete:
+            for path in self.find_orphans():
+                yield 'orphaned', None, None, path
+        self._clear_checkpoint(operation)
+
+    def find_orphans(self):
+        """Yield the paths of files no attachment refers to.
+
+        Files in `cold_dir` are expected if an attachment file links to
+        them. The attachment directories are checked in ranges of buckets,
+        with one pass over the `attachment` table per range, so that only
+        about `orphan_batch_size` expected paths are kept in memory at once.
+        """
+        count = self.env.db_query("""
+                SELECT COUNT(*) FROM attachment WHERE type=%s
+                """, (self.realm,))[0][0]
+        passes = min(self.buckets, max(1, -(-count // self.orphan_batch_size)))
+        roots = [(self.env.attachments_dir, False)]
+        if self.cold_dir:
+            roots.append((os.path.realpath(self.cold_dir), True))
+
+        for n in range(passes):
+            first = self.buckets * n // passes
+            last = self.buckets * (n + 1) // passes
+            expected = set()
+            for rows in self._select_batches(None, resume=False):
+                for id, filename, size in rows:
+                    path = self._get_path(id, filename)
+                    if first <= self._bucket(path, self.env.attachments_dir) < last:
+                        expected.add(self._path_key(path))
+                    if self.cold_dir and os.path.islink(path):
+                        target = os.path.realpath(path)
+                        if first <= self._bucket(target, roots[-1][0]) < last:
+                            expected.add(self._path_key(target))
+
+            for root, resolve in roots:
+                for bucket in range(first, last):
+                    bucket_dir = os.path.join(root, self.realm, '%03x' % (bucket,))
+                    for dirpath, dirnames, filenames in os.walk(bucket_dir):
+                        for filename in filenames:
+                            path = os.path.join(dirpath, filename)
+                            if resolve:
+                                path = os.path.realpath(path)
+                            if self._path_key(path) not in expected:
+                                yield path
+
+    def _bucket(self, path, root):
+        """Return the bucket of an attachment file below `root`, or -1."""
+        parts = os.path.normpath(os.path.relpath(path, root)).split(os.sep)
+        if len(parts) == 4 and parts[0] == self.realm:
+            try:
+                return int(parts[1], 16)
+            except ValueError:
+                pass
+        return -1
+
+    def _select_batches(self, operation, resume):
+        last = self._get_checkpoint(operation) if resume else None
+        while True:
+            sql = """
+                SELECT id, filename, size
+                FROM attachment
+                WHERE type=%s"""
+            args = [self.realm]
+            if last:
+                sql += " AND (id>%s OR (id=%s AND filename>%s))"
+                args += [last[0], last[0], last[1]]
+            rows = self.env.db_query(sql + """
+                ORDER BY id, filename
+                LIMIT %d
+                """ % (self.batch_size,), args)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.batch_size:
+                return
+            last = rows[-1][:2]
+
+    def _check_rename(self, id, filename, new_filename, new_paths):
+        """Return why the attachment can not be renamed, or `None`.
+
+        `new_paths` are the paths other attachments of the batch are renamed
+        to. Conflicts are reported and skipped rather than raised, so they
+        can not stop a resumed run at the same batch forever.
+        """
+        new_path = self._get_path(id, new_filename)
+
+        # Make sure the path to the attachment is inside the environment
+        # attachments directory
+        commonprefix = os.path.commonprefix([self.env.attachments_dir,
+                                             new_path])
+        if commonprefix != self.env.attachments_dir:
+            return "new filename is invalid"
+        if os.path.exists(new_path) or new_path in new_paths or \
+                self.env.db_query("""
+                    SELECT filename FROM attachment
+                    WHERE type=%s AND id=%s AND filename=%s
+                    """, (self.realm, id, new_filename)):
+            return "an attachment with the new filename already exists"
+        return None
+
+    def _rename_batch(self, operation, renames, last):
+        moved = []
+        try:
+            with self.env.db_transaction as db:
+                for id, filename, new_filename in renames:
+                    self.env.log.info("Renaming attachment of %s:%s from '%s' to '%s'",
+                                      self.realm, id, filename, new_filename)
+                    path = self._get_path(id, filename)
+                    new_path = self._get_path(id, new_filename)
+
+                    db("""UPDATE attachment SET filename=%s
+                          WHERE type=%s AND id=%s AND filename=%s
+                          """, (new_filename, self.realm, id, filename))
+                    if os.path.isfile(path):
+                        dirname = os.path.dirname(new_path)
+                        if not os.path.exists(dirname):
+                            os.makedirs(dirname)
+                        try:
+                            os.rename(path, new_path)
+                        except OSError as e:
+                            self.env.log.error("Failed to move attachment file %s: %s",
+                                               path,
+                                               exception_to_unicode(e, traceback=True))
+                            raise TracError(_("Could not rename attachment %(name)s",
+                                              name=filename))
+                        moved.append((path, new_path))
+                self._set_checkpoint(db, operation, last)
+        except Exception:
+            # The database changes of the batch are rolled back, so move the
+            # files back as well
+            for path, new_path in reversed(moved):
+                try:
+                    os.rename(new_path, path)
+                except OSError as e:
+                    self.env.log.error("Failed to move attachment file %s back: %s",
+                                       new_path, exception_to_unicode(e))
+            raise
+
+    def _get_path(self, id, filename):
+        return Attachment._get_path(self.env.attachments_dir, self.realm,
+                                    id, filename)
+
+    def _path_key(self, path):
+        path = os.path.normpath(path)
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return hashlib.sha1(path).digest()
+
+    # Checkpoints
+
+    def _checkpoint_name(self, operation):
+        return 'mailarchive.maintenance.%s' % (operation,)
+
+    def _get_checkpoint(self, operation):
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name=%s
+                """, (self._checkpoint_name(operation),)):
+            return json.loads(value)
+        return None
+
+    def _set_checkpoint(self, db, operation, last):
+        name = self._checkpoint_name(operation)
+        value = json.dumps(list(last))
+        if db("SELECT value FROM system WHERE name=%s", (name,)):
+            db("UPDATE system SET value=%s WHERE name=%s", (value, name))
+        else:
+            db("INSERT INTO system (name, value) VALUES (%s, %s)", (name, value))
+
+    def _clear_checkpoint(self, operation):
+        if not self.dry_run:
+            with self.env.db_transaction as db:
+                db("DELETE FROM system WHERE name=%s",
+                   (self._checkpoint_name(operation),))
@@ -2,8 +2,9 @@
 
 from datetime import datetime, tzinfo
 import email
+import hashlib
 from email.header import decode_header
-from email.utils import parsedate_tz, mktime_tz
+from email.utils import getaddresses, parsedate_tz, mktime_tz
 import re
 from tempfile import TemporaryFile
 import unicodedata
@@ -13,7 +14,7 @@ from trac.db import Table, Column, Index
 from trac.mimeview.api import KNOWN_MIME_TYPES
 from trac.resource import Resource
 from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
-from trac.util.text import stripws
+from trac.util.text import exception_to_unicode, stripws
 
 try:
     unichr
@@ -25,8 +26,12 @@ try:
 except NameError:
     xrange = range # In Python 3 range can be used instead of xrange in Python 2
 
-SCHEMA = [
-    Table('mailarchive', key='id')[
+HOT_TABLE = 'mailarchive'
+COLD_TABLE = 'mailarchive_cold'
+FACET_TABLE = 'mailarchive_facet'
+
+def mail_table(name):
+    return Table(name, key='id')[
         Column('id'),
         Column('subject'),
         Column('fromheader'),
@@ -35,10 +40,27 @@ SCHEMA = [
         Column('body'),
         Column('allheaders'),
         Column('comment'),
+        Column('digest'),
+        Column('sender'),
         Index(['date']),
-    ],
+        Index(['digest']),
+        Index(['sender']),
+    ]
+
+facet_table = Table(FACET_TABLE, key=('facet', 'value'))[
+    Column('facet'),
+    Column('value'),
+    Column('count', type='int'),
+]
+
+SCHEMA = [
+    mail_table(HOT_TABLE),
+    mail_table(COLD_TABLE),
+    facet_table,
 ]
 
+MAIL_COLUMNS = ('id', 'subject', 'fromheader', 'toheader', 'body', 'allheaders', 'date', 'comment', 'digest', 'sender')
+
 
 EXT_MAP = dict((t, exts[0]) for t, exts in KNOWN_MIME_TYPES.items())
 EXT_MAP['image/gif'] = 'gif'
@@ -73,6 +95,63 @@ def to_unicode(s, charset):
 def get_charset(m, default='ASCII'):
     return m.get_content_charset() or m.get_charset() or default
 
+# Headers set by the sender, identifying a message regardless of how and how
+# often it was delivered.
+DIGEST_HEADERS = ('message-id', 'date', 'from', 'to', 'cc', 'subject')
+
+HEADER_END_RE = re.compile(r'\r?\n\r?\n')
+FOLDING_RE = re.compile(r'\r?\n(?=[ \t])')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalized_body(body):
+    """Return the body with whitespace collapsed, for comparing mails."""
+    return WHITESPACE_RE.sub(' ', body or u'').strip()
+
+def message_digest(source, body=None):
+    """Return a hex digest identifying a message.
+
+    `source` is either the raw message or the header block stored in
+    `allheaders`. Only the header block is read, it is unfolded, whitespace
+    is collapsed and only the `DIGEST_HEADERS` are used, so the same message
+    received by several mailboxes or delivered again has the same digest,
+    and the digest of an archived mail can be computed from `allheaders`.
+
+    Messages without a Message-ID are not told apart reliably by their
+    headers, so for them a hash of the decoded `body` is added. If such a
+    message is given without `body`, `None` is returned.
+    """
+    if isinstance(source, bytes):
+        source = source.decode('ascii', 'replace')
+    headers = FOLDING_RE.sub(' ', HEADER_END_RE.split(source or u'', 1)[0])
+    values = {}
+    for line in headers.splitlines():
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        if sep and name in DIGEST_HEADERS and name not in values:
+            values[name] = WHITESPACE_RE.sub(' ', value).strip()
+    names = DIGEST_HEADERS
+    if not values.get('message-id'):
+        if body is None:
+            return None
+        values['body'] = hashlib.sha1(normalized_body(body).encode('utf-8')).hexdigest()
+        names += ('body',)
+    normalized = u'\n'.join(u'%s: %s' % (name, values.get(name, u''))
+                             for name in names)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+def sender_address(fromheader):
+    """Return the lower-cased address of a From header, for the sender facet."""
+    for name, addr in getaddresses([fromheader or '']):
+        if addr:
+            return addr.lower()
+    return (fromheader or '').strip().lower()
+
+def mail_facets(date, sender):
+    """Return the `(facet, value)` pairs a mail is counted in. `sender` is
+    the normalized address returned by `sender_address`."""
+    return [('month', date.astimezone(utc).strftime('%Y-%m')),
+            ('sender', sender)]
+
 def terms_to_clauses(terms):
     """Split list of search terms and the 'or' keyword into list of lists of search terms."""
     clauses = [[]]
@@ -102,9 +181,52 @@ def search_clauses_to_sql(db, columns, clauses):
             args.extend(['%' + db.like_escape(term) + '%'] * len(columns))
     return sql, tuple(args)
 
+def filter_to_sql(db, filter, start=None, end=None, sender=None):
+    """Convert a filter string, an optional date range and an optional sender
+    address into an SQL WHERE clause and corresponding parameters.
+
+    `start` is inclusive and `end` is exclusive. The result is returned as an
+    `(sql, params)` tuple.
+    """
+    clauses = []
+    args = []
+    if filter:
+        sql, filter_args = search_clauses_to_sql(db, ['body', 'allheaders', 'comment'], terms_to_clauses(filter.split()))
+        clauses.append(sql)
+        args.extend(filter_args)
+    if start is not None:
+        clauses.append('date>=%s')
+        args.append(to_utimestamp(start))
+    if end is not None:
+        clauses.append('date<%s')
+        args.append(to_utimestamp(end))
+    if sender:
+        clauses.append('sender=%s')
+        args.append(sender.lower())
+    if not clauses:
+        return '1=1', ()
+    return ' AND '.join('(%s)' % clause for clause in clauses), tuple(args)
+
+def mail_tables(include_cold=False):
+    """Return the tables to query: only the hot tier, or both tiers."""
+    return (HOT_TABLE, COLD_TABLE) if include_cold else (HOT_TABLE,)
+
+def select_mails_sql(where, args, include_cold=False, columns=MAIL_COLUMNS):
+    """Return an SQL query selecting `columns` of the mails matching the
+    `where` clause from the hot tier, or from both tiers if `include_cold`
+    is set, and the corresponding parameters.
+
+    An `ORDER BY` or `LIMIT` appended to the query applies to all tiers.
+    The result is returned as an `(sql, params)` tuple.
+    """
+    tables = mail_tables(include_cold)
+    sql = ' UNION ALL '.join("SELECT %s FROM %s WHERE %s" % (', '.join(columns), table, where)
+                             for table in tables)
+    return sql, tuple(args) * len(tables)
+
 class ArchivedMail(object):
 
-    def __init__(self, id, subject, fromheader, toheader, body, allheaders, date, comment):
+    def __init__(self, id, subject, fromheader, toheader, body, allheaders, date, comment, digest=None, sender=None):
         self.id = id
         self.subject = subject
         self.fromheader = fromheader
@@ -113,6 +235,9 @@ class ArchivedMail(object):
         self.allheaders = allheaders
         self.date = from_utimestamp(date)
         self.comment = comment
+        self.digest = digest
+        self.sender = sender if sender is not None else sender_address(fromheader)
+        self.archived = False
 
     @classmethod
     def parse(cls, id, source):
@@ -131,6 +256,7 @@ class ArchivedMail(object):
                     break
 
         date = datetime.fromtimestamp(mktime_tz(parsedate_tz(msg['date'])), utc)
+        body = to_unicode(body, charset)
 
         allheaders = '\n'.join("%s: %s" % item for item in msg.items())
 
@@ -138,10 +264,11 @@ class ArchivedMail(object):
                             header_to_unicode(msg['subject']),
                             header_to_unicode(msg['from']),
                             header_to_unicode(msg['to']),
-                            to_unicode(body, charset),
+                            body,
                             to_unicode(allheaders, 'ASCII'),
                             to_utimestamp(date),
-                            '')
+                            '',
+                            message_digest(source, body or u''))
         return (mail, msg)
 
     @classmethod
@@ -151,9 +278,63 @@ class ArchivedMail(object):
             cursor = db.cursor()
             cursor.execute("""
             INSERT INTO mailarchive
-                        (id, subject, fromheader, toheader, body, allheaders, date, comment)
-                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (mail.id, mail.subject, mail.fromheader, mail.toheader, mail.body, mail.allheaders, to_utimestamp(mail.date), mail.comment))
+                        (id, subject, fromheader, toheader, body, allheaders, date, comment, digest, sender)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (mail.id, mail.subject, mail.fromheader, mail.toheader, mail.body, mail.allheaders, to_utimestamp(mail.date), mail.comment, mail.digest, mail.sender))
+
+        # Update the facet counts separately, failing to do so must not lose
+        # the mail
+        try:
+            cls.update_facets(env, mail_facets(mail.date, mail.sender), 1)
+        except Exception as e:
+            env.log.error("Failed to update the facet counts of mail %s: %s",
+                          mail.id, exception_to_unicode(e, traceback=True))
+
+    @classmethod
+    def update_facets(cls, env, facets, delta):
+        """Add `delta` to the counts of the given `(facet, value)` pairs.
+
+        Each pair is updated in its own transaction. If a concurrent
+        transaction inserts the same pair first, the update is retried.
+        """
+        for facet, value in facets:
+            for retry in (True, False):
+                try:
+                    with env.db_transaction as db:
+                        cursor = db.cursor()
+                        cursor.execute("""
+                        UPDATE mailarchive_facet
+                           SET count=count+%s
+                         WHERE facet=%s AND value=%s
+                        """, (delta, facet, value))
+                        if cursor.rowcount == 0 and delta > 0:
+                            cursor.execute("""
+                            INSERT INTO mailarchive_facet (facet, value, count)
+                                 VALUES (%s, %s, %s)
+                            """, (facet, value, delta))
+                        elif delta < 0:
+                            cursor.execute("""
+                            DELETE FROM mailarchive_facet
+                             WHERE facet=%s AND value=%s AND count<=0
+                            """, (facet, value))
+                    break
+                except env.db_exc.IntegrityError:
+                    if not retry:
+                        raise
+
+    @classmethod
+    def select_facet_counts(cls, env, facet, by_count=False, limit=None):
+        """Return `(value, count)` tuples of a facet, ordered by descending
+        value, or by descending count if `by_count` is set."""
+        order = 'count DESC, value' if by_count else 'value DESC'
+        sql = """
+            SELECT value, count FROM mailarchive_facet
+            WHERE facet=%%s
+            ORDER BY %s
+            """ % (order,)
+        if limit:
+            sql += " LIMIT %d" % (limit,)
+        return env.db_query(sql, (facet,))
 
     @classmethod
     def storeattachments(cls, env, mail, msg):
@@ -193,97 +374,232 @@ class ArchivedMail(object):
                 add_attachment(part.get_payload(decode=True), filename)
 
     @classmethod
-    def select_all(cls, env):
+    def select_all(cls, env, include_cold=True):
         with env.db_query as db:
-            return [ArchivedMail(id, subject, fromheader, toheader, body, allheaders, date, comment)
-                    for id, subject, fromheader, toheader, body, allheaders, date, comment in
-                    db("""
-                    SELECT id, subject, fromheader, toheader, body, allheaders, date, comment
-                    FROM mailarchive
-                    """)]
+            sql, args = select_mails_sql('1=1', (), include_cold)
+            return [cls(*row) for row in db(sql, args)]
 
     @classmethod
-    def select_all_paginated(cls, env, page, max_per_page):
-        with env.db_query as db:
-            return [ArchivedMail(id, subject, fromheader, toheader, body, allheaders, date, comment)
-                    for id, subject, fromheader, toheader, body, allheaders, date, comment in
-                    db("""
-                    SELECT id, subject, fromheader, toheader, body, allheaders, date, comment
-                    FROM mailarchive
-                    ORDER BY date DESC
-                    LIMIT %d OFFSET %d
-                    """ % (max_per_page, max_per_page * (page - 1)))]
+    def select_all_paginated(cls, env, page, max_per_page, include_cold=False):
+        return cls.select_filtered_paginated(env, page, max_per_page, None, include_cold)
 
     @classmethod
-    def count_all(cls, env):
+    def select_filtered_batches(cls, env, filter=None, start=None, end=None, batch_size=500, include_cold=False):
+        """Yield lists of at most `batch_size` mails ordered by date.
+
+        Uses keyset pagination on `(date, id)` so each batch is a separate
+        indexed query and memory use does not depend on the archive size.
+        """
+        last = None
+        while True:
+            with env.db_query as db:
+                sql_query, args = filter_to_sql(db, filter, start, end)
+                if last is not None:
+                    sql_query += " AND (date>%s OR (date=%s AND id>%s))"
+                    args += (last[0], last[0], last[1])
+                sql, args = select_mails_sql(sql_query, args, include_cold)
+                rows = db(sql + " ORDER BY date, id LIMIT %d" % (batch_size,), args)
+            if not rows:
+                return
+            yield [cls(*row) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last = (rows[-1][6], rows[-1][0])
+
+    @classmethod
+    def select_attachments(cls, env, ids):
+        """Return a dict mapping each of the given mail ids to its list of
+        attachments, using a single query."""
+        attachments = dict((str(id), []) for id in ids)
+        if not attachments:
+            return attachments
         with env.db_query as db:
-            return db("""
-                    SELECT COUNT(*)
-                    FROM mailarchive
-                    """)[0][0]
+            for id, filename, description, size, time, author in db("""
+                    SELECT id, filename, description, size, time, author
+                    FROM attachment
+                    WHERE type='mailarchive' AND id IN (%s)
+                    ORDER BY id, filename
+                    """ % ','.join(['%s'] * len(attachments)), list(attachments)):
+                attachment = Attachment(env, 'mailarchive', id)
+                attachment._from_database(filename, description, size, time, author)
+                attachments[id].append(attachment)
+        return attachments
 
     @classmethod
-    def select_filtered_paginated(cls, env, page, max_per_page, filter):
-        if not filter:
-            return cls.select_all_paginated(env, page, max_per_page)
+    def count_all(cls, env, include_cold=False):
+        return cls.count_filtered(env, None, include_cold)
+
+    @classmethod
+    def select_filtered_paginated(cls, env, page, max_per_page, filter, include_cold=False,
+                                  start=None, end=None, sender=None):
         with env.db_query as db:
-            terms = filter.split()
-            sql_query, args = search_clauses_to_sql(db, ['body', 'allheaders', 'comment'], terms_to_clauses(terms))
-            return [ArchivedMail(id, subject, fromheader, toheader, body, allheaders, date, comment)
-                    for id, subject, fromheader, toheader, body, allheaders, date, comment in
-                    db("""
-                    SELECT id, subject, fromheader, toheader, body, allheaders, date, comment
-                    FROM mailarchive
-                    WHERE %s
+            sql_query, args = filter_to_sql(db, filter, start, end, sender)
+            sql, args = select_mails_sql(sql_query, args, include_cold)
+            return [cls(*row) for row in db(sql + """
                     ORDER BY date DESC
                     LIMIT %d OFFSET %d
-                    """ % (sql_query, max_per_page, max_per_page * (page - 1)), args)]
+                    """ % (max_per_page, max_per_page * (page - 1)), args)]
 
     @classmethod
-    def count_filtered(cls, env, filter):
-        if not filter:
-            return cls.count_all(env)
+    def count_filtered(cls, env, filter, include_cold=False, start=None, end=None, sender=None):
         with env.db_query as db:
-            terms = filter.split()
-            sql_query, args = search_clauses_to_sql(db, ['body', 'allheaders', 'comment'], terms_to_clauses(terms))
-            return db("""
+            sql_query, args = filter_to_sql(db, filter, start, end, sender)
+            return sum(db("""
                     SELECT COUNT(*)
-                    FROM mailarchive
-                    WHERE
-                    """ + sql_query, args)[0][0]
+                    FROM %s
+                    WHERE %s
+                    """ % (table, sql_query), args)[0][0]
+                    for table in mail_tables(include_cold))
 
     @classmethod
-    def search(cls, env, terms, max=0):
+    def search(cls, env, terms, max=0, include_cold=False):
         with env.db_query as db:
             sql_query, args = search_clauses_to_sql(db, ['body', 'allheaders', 'comment'], terms_to_clauses(terms))
+            sql, args = select_mails_sql(sql_query, args, include_cold)
             if max > 0:
-                sql_query += " LIMIT %d" % (max,)
-            return [ArchivedMail(id, subject, fromheader, toheader, body, allheaders, date, comment)
-                    for id, subject, fromheader, toheader, body, allheaders, date, comment in
-                    db("""
-                    SELECT id, subject, fromheader, toheader, body, allheaders, date, comment
-                    FROM mailarchive
-                    WHERE
-                    """ + sql_query, args)]
+                sql += " LIMIT %d" % (max,)
+            return [cls(*row) for row in db(sql, args)]
 
     @classmethod
-    def select_by_id(cls, env, id):
-        rows = env.db_query("""
-                SELECT id, subject, fromheader, toheader, body, allheaders, date, comment
-                FROM mailarchive
-                WHERE id=%s
-                """, (str(id),))
-        if not rows:
-            return None
-        id, subject, fromheader, toheader, body, allheaders, date, comment = rows[0]
-        return ArchivedMail(id, subject, fromheader, toheader, body, allheaders, date, comment)
+    def select_by_id(cls, env, id, include_cold=True, with_body=True):
+        """Return the mail with the given id, or `None`.
+
+        Without `with_body` the `body` is not loaded and is `None`, see
+        `select_text_chunk`.
+        """
+        columns = MAIL_COLUMNS if with_body else \
+                  tuple('NULL' if column == 'body' else column for column in MAIL_COLUMNS)
+        for table in mail_tables(include_cold):
+            rows = env.db_query("""
+                    SELECT %s
+                    FROM %s
+                    WHERE id=%%s
+                    """ % (', '.join(columns), table), (str(id),))
+            if rows:
+                mail = cls(*rows[0])
+                mail.archived = table == COLD_TABLE
+                return mail
+        return None
+
+    @classmethod
+    def select_summaries_between(cls, env, start, stop):
+        """Return the mails dated between `start` and `stop`, most recent
+        first, with only `id`, `subject`, `fromheader` and `date` loaded."""
+        columns = tuple(column if column in ('id', 'subject', 'fromheader', 'date') else 'NULL'
+                        for column in MAIL_COLUMNS)
+        sql, args = select_mails_sql('date>=%s AND date<=%s',
+                                     (to_utimestamp(start), to_utimestamp(stop)),
+                                     include_cold=True, columns=columns)
+        return [cls(*row) for row in env.db_query(sql + " ORDER BY date DESC", args)]
+
+    @classmethod
+    def select_text_chunk(cls, env, id, column, offset, length):
+        """Return `length` characters of the `body` or `allheaders` of a mail,
+        starting at `offset`, as a `(text, more)` tuple, where `more` tells
+        whether the text continues. Returns `None` if the mail does not exist.
+
+        The text is sliced by the database, so a chunk of a huge mail can be
+        read without loading its full text.
+        """
+        assert column in ('body', 'allheaders')
+        for table in mail_tables(include_cold=True):
+            # Ask for one more character to find out whether there is more
+            rows = env.db_query("""
+                    SELECT SUBSTR(%s, %%s, %%s)
+                    FROM %s
+                    WHERE id=%%s
+                    """ % (column, table), (offset + 1, length + 1, str(id)))
+            if rows:
+                text = rows[0][0] or u''
+                return text[:length], len(text) > length
+        return None
+
+    @classmethod
+    def select_existing_ids(cls, env, ids):
+        """Return the set of the given mail ids that are archived."""
+        ids = [str(id) for id in ids]
+        if not ids:
+            return set()
+        sql, args = select_mails_sql('id IN (%s)' % ','.join(['%s'] * len(ids)), ids,
+                                     include_cold=True, columns=('id',))
+        return set(id for id, in env.db_query(sql, args))
+
+    @classmethod
+    def select_existing_digests(cls, env, digests):
+        """Return the set of the given digests that are archived, using a
+        single indexed query."""
+        digests = list(digests)
+        if not digests:
+            return set()
+        sql, args = select_mails_sql('digest IN (%s)' % ','.join(['%s'] * len(digests)), digests,
+                                     include_cold=True, columns=('digest',))
+        return set(digest for digest, in env.db_query(sql, args))
+
+    @classmethod
+    def select_digest_batches(cls, env, batch_size=10000):
+        """Yield lists of the digests of all archived mails, in keyset
+        batches over the digest index."""
+        for table in mail_tables(include_cold=True):
+            last = ''
+            while True:
+                digests = [digest for digest, in env.db_query("""
+                        SELECT digest FROM %s
+                        WHERE digest>%%s
+                        ORDER BY digest
+                        LIMIT %d
+                        """ % (table, batch_size), (last,))]
+                if not digests:
+                    break
+                yield digests
+                if len(digests) < batch_size:
+                    break
+                last = digests[-1]
+
+    @classmethod
+    def select_duplicate_digests(cls, env):
+        """Return the digests shared by more than one archived mail."""
+        sql, args = select_mails_sql('digest IS NOT NULL', (), include_cold=True,
+                                     columns=('digest',))
+        return [digest for digest, in env.db_query("""
+                SELECT digest FROM (%s) mails
+                GROUP BY digest
+                HAVING COUNT(*)>1
+                """ % (sql,), args)]
+
+    @classmethod
+    def select_by_digest(cls, env, digest):
+        """Return the archived mails with the given digest, oldest first."""
+        sql, args = select_mails_sql('digest=%s', (digest,), include_cold=True)
+        return [cls(*row) for row in env.db_query(sql + " ORDER BY date, id", args)]
+
+    @classmethod
+    def delete(cls, env, mail):
+        with env.db_transaction as db:
+            for table in mail_tables(include_cold=True):
+                db("DELETE FROM %s WHERE id=%%s" % (table,), (str(mail.id),))
+            cls.update_facets(env, mail_facets(mail.date, mail.sender), -1)
+
+    @classmethod
+    def move_to_tier(cls, env, ids, cold):
+        """Move the given mails to the cold tier, or back to the hot tier."""
+        source, target = (HOT_TABLE, COLD_TABLE) if cold else (COLD_TABLE, HOT_TABLE)
+        columns = ', '.join(MAIL_COLUMNS)
+        ids = [str(id) for id in ids]
+        with env.db_transaction as db:
+            holders = ','.join(['%s'] * len(ids))
+            db("""
+            INSERT INTO %s (%s)
+                 SELECT %s FROM %s WHERE id IN (%s)
+            """ % (target, columns, columns, source, holders), ids)
+            db("DELETE FROM %s WHERE id IN (%s)" % (source, holders), ids)
 
     @classmethod
     def update_comment(cls, env, id, comment):
         with env.db_transaction as db:
             cursor = db.cursor()
-            cursor.execute("""
-            UPDATE mailarchive
-               SET comment=%s
-             WHERE id=%s
-            """, (comment, str(id)))
+            for table in mail_tables(include_cold=True):
+                cursor.execute("""
+                UPDATE %s
+                   SET comment=%%s
+                 WHERE id=%%s
+                """ % (table,), (comment, str(id)))
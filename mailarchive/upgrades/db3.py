@@ -0,0 +1,18 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+
+new_table = Table('mailarchive_cold', key='id')[
+        Column('id'),
+        Column('subject'),
+        Column('fromheader'),
+        Column('toheader'),
+        Column('date', type='int64'),
+        Column('body'),
+        Column('allheaders'),
+        Column('comment'),
+        Index(['date']),
+    ]
+
+
+def do_upgrade(env, ver, cursor):
+    DatabaseManager(env).create_tables([new_table])
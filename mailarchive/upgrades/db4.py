@@ -0,0 +1,47 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+from mailarchive.model import message_digest
+
+
+def new_table(name):
+    return Table(name, key='id')[
+        Column('id'),
+        Column('subject'),
+        Column('fromheader'),
+        Column('toheader'),
+        Column('date', type='int64'),
+        Column('body'),
+        Column('allheaders'),
+        Column('comment'),
+        Column('digest'),
+        Index(['date']),
+        Index(['digest']),
+    ]
+
+
+def do_upgrade(env, ver, cursor):
+    for table in ('mailarchive', 'mailarchive_cold'):
+        cursor.execute("CREATE TEMPORARY TABLE %s_old AS SELECT * FROM %s" % (table, table))
+        cursor.execute("DROP TABLE %s" % (table,))
+
+        DatabaseManager(env).create_tables([new_table(table)])
+
+        cursor.execute("""
+            INSERT INTO %s (id, subject, fromheader, toheader, date, body, allheaders, comment)
+            SELECT o.id, o.subject, o.fromheader, o.toheader, o.date, o.body, o.allheaders, o.comment
+            FROM %s_old o
+            """ % (table, table))
+        cursor.execute("DROP TABLE %s_old" % (table,))
+
+        # Compute the digests of the existing mails from their headers and,
+        # without a Message-ID, their body
+        while True:
+            cursor.execute("""
+                SELECT id, allheaders, body FROM %s WHERE digest IS NULL LIMIT 1000
+                """ % (table,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            cursor.executemany("UPDATE %s SET digest=%%s WHERE id=%%s" % (table,),
+                               [(message_digest(allheaders, body or u''), id)
+                                for id, allheaders, body in rows])
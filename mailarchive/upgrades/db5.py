@@ -0,0 +1,66 @@
+from trac.db import Table, Column, Index, DatabaseManager
+from trac.util.datefmt import from_utimestamp
+
+from mailarchive.model import mail_facets, sender_address
+
+
+def new_table(name):
+    return Table(name, key='id')[
+        Column('id'),
+        Column('subject'),
+        Column('fromheader'),
+        Column('toheader'),
+        Column('date', type='int64'),
+        Column('body'),
+        Column('allheaders'),
+        Column('comment'),
+        Column('digest'),
+        Column('sender'),
+        Index(['date']),
+        Index(['digest']),
+        Index(['sender']),
+    ]
+
+facet_table = Table('mailarchive_facet', key=('facet', 'value'))[
+    Column('facet'),
+    Column('value'),
+    Column('count', type='int'),
+]
+
+
+def do_upgrade(env, ver, cursor):
+    counts = {}
+    for table in ('mailarchive', 'mailarchive_cold'):
+        cursor.execute("CREATE TEMPORARY TABLE %s_old AS SELECT * FROM %s" % (table, table))
+        cursor.execute("DROP TABLE %s" % (table,))
+
+        DatabaseManager(env).create_tables([new_table(table)])
+
+        cursor.execute("""
+            INSERT INTO %s (id, subject, fromheader, toheader, date, body, allheaders, comment, digest)
+            SELECT o.id, o.subject, o.fromheader, o.toheader, o.date, o.body, o.allheaders, o.comment, o.digest
+            FROM %s_old o
+            """ % (table, table))
+        cursor.execute("DROP TABLE %s_old" % (table,))
+
+        # Store the normalized sender address and count the facets
+        while True:
+            cursor.execute("""
+                SELECT id, fromheader, date FROM %s WHERE sender IS NULL LIMIT 1000
+                """ % (table,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for id, fromheader, date in rows:
+                sender = sender_address(fromheader)
+                updates.append((sender, id))
+                for key in mail_facets(from_utimestamp(date), sender):
+                    counts[key] = counts.get(key, 0) + 1
+            cursor.executemany("UPDATE %s SET sender=%%s WHERE id=%%s" % (table,), updates)
+
+    DatabaseManager(env).create_tables([facet_table])
+    cursor.executemany("""
+        INSERT INTO mailarchive_facet (facet, value, count)
+        VALUES (%s, %s, %s)
+        """, [(facet, value, count) for (facet, value), count in counts.items()])
@@ -1,19 +1,23 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime
+import json
 import re
 from email.utils import getaddresses
 from pkg_resources import resource_filename
 
 from trac.attachment import AttachmentModule, ILegacyAttachmentPolicyDelegate
-from trac.config import Option
+from trac.config import IntOption, Option
 from trac.core import *
 from trac.perm import IPermissionRequestor
 from trac.resource import IResourceManager, Resource, ResourceNotFound, resource_exists
 from trac.search import ISearchSource, shorten_result
+from trac.timeline.api import ITimelineEventProvider
 from trac.util.html import escape, tag
-from trac.util.datefmt import format_datetime
+from trac.util.datefmt import format_datetime, parse_date, user_time, utc
 from trac.util.presentation import Paginator
-from trac.web import IRequestHandler
+from trac.web import IRequestHandler, RequestDone
+from trac.web.api import HTTPBadRequest
 from trac.web.chrome import (INavigationContributor, ITemplateProvider,
                              add_link, add_notice, add_script, prevnext_nav,
                              web_context)
@@ -21,6 +25,7 @@ from trac.wiki.formatter import format_to_html
 from trac.wiki.macros import WikiMacroBase
 from trac.wiki.api import IWikiSyntaxProvider, parse_args
 
+from mailarchive.export import EXPORT_FORMATS, export_mails
 from mailarchive.model import ArchivedMail
 from mailarchive.admin import MailArchiveAdmin
 
@@ -43,7 +48,8 @@ class MailArchiveModule(Component):
     """Archived emails."""
 
     implements(ILegacyAttachmentPolicyDelegate, INavigationContributor, IPermissionRequestor,
-               IRequestHandler, IResourceManager, ISearchSource, ITemplateProvider, IWikiSyntaxProvider)
+               IRequestHandler, IResourceManager, ISearchSource, ITemplateProvider,
+               ITimelineEventProvider, IWikiSyntaxProvider)
 
     help = Option('mailarchive', 'help', '**Note:** See MailArchive for help on using the mail archive.',
                   """Help text shown at bottom in wiki format.""")
@@ -57,6 +63,14 @@ class MailArchiveModule(Component):
     password = Option('mailarchive', 'password',
                   """Password to fetch mail with.""")
 
+    top_senders = IntOption('mailarchive', 'top_senders', 20,
+                  """Number of senders offered for browsing the mail archive.""")
+
+    text_chunk_size = IntOption('mailarchive', 'text_chunk_size', 65536,
+                  """Number of characters of a mail body sent with the page,
+                  and sent per request when more of the body or the headers
+                  are shown.""")
+
     # ILegacyAttachmentPolicyDelegate
 
     def check_attachment_permission(self, action, username, resource, perm):
@@ -100,13 +114,15 @@ class MailArchiveModule(Component):
 
     # IRequestHandler methods
 
-    MATCH_REQUEST_RE = re.compile(r'/mailarchive(?:/(\d+))?$')
+    MATCH_REQUEST_RE = re.compile(r'/mailarchive(?:/(\d+)(?:/(body|headers))?|/(export))?$')
 
     def match_request(self, req):
         match = self.MATCH_REQUEST_RE.match(req.path_info)
         if match:
             if match.group(1):
                 req.args['message-id'] = match.group(1)
+            if match.group(2) or match.group(3):
+                req.args['mailarchive-action'] = match.group(2) or match.group(3)
             return True
 
     def process_request(self, req):
@@ -123,45 +139,128 @@ class MailArchiveModule(Component):
                 ArchivedMail.update_comment(self.env, id, comment)
                 add_notice(req, "The comment has been updated.")
 
+        action = req.args.get('mailarchive-action')
+        if action == 'export':
+            self._send_export(req)
         if 'message-id' in req.args:
             id = int(req.args.get('message-id'))
+            if action in ('body', 'headers'):
+                self._send_text_chunk(req, id, action)
             return self._render_mail(req, id)
         return self._render_list(req)
 
+    def _send_export(self, req):
+        format = req.args.get('format', 'mbox')
+        if format not in EXPORT_FORMATS:
+            raise HTTPBadRequest("Unknown export format '%s'" % (format,))
+        filter = req.args.get('filter', '')
+        since = req.args.get('since')
+        until = req.args.get('until')
+        start = user_time(req, parse_date, since, hint='datetime') if since else None
+        end = user_time(req, parse_date, until, hint='datetime') if until else None
+        with_attachments = bool(req.args.get('attachments'))
+
+        # No Content-Length: the response is streamed as it is generated.
+        req.send_response(200)
+        req.send_header('Content-Type', EXPORT_FORMATS[format] + ';charset=utf-8')
+        req.send_header('Content-Disposition',
+                        'attachment; filename=mailarchive.%s' % (format,))
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(export_mails(self.env, format, filter, start, end,
+                                   with_attachments))
+        raise RequestDone
+
+    @property
+    def _chunk_size(self):
+        # A chunk must contain at least one character, or the page would
+        # keep asking for the same chunk
+        return max(1, self.text_chunk_size)
+
+    def _send_text_chunk(self, req, id, part):
+        offset = req.args.getint('offset', 0, min=0)
+        column = 'allheaders' if part == 'headers' else 'body'
+        chunk = ArchivedMail.select_text_chunk(self.env, id, column, offset,
+                                               self._chunk_size)
+        if chunk is None:
+            raise ResourceNotFound("Mail does not exist")
+        text, more = chunk
+        data = {
+            'text': text,
+            'next_offset': offset + len(text) if more else None,
+        }
+        req.send(json.dumps(data), 'application/json')
+
     def _render_list(self, req):
         page = int(req.args.get('page', 1))
         max_per_page = int(req.args.get('max', 40))
         filter = req.args.get('filter', '')
+        archived = bool(req.args.get('archived'))
+        month = req.args.get('month')
+        sender = req.args.get('sender')
         context = web_context(req, 'mailarchive')
 
+        start = end = None
+        if month:
+            try:
+                start = datetime.strptime(month, '%Y-%m').replace(tzinfo=utc)
+            except ValueError:
+                raise HTTPBadRequest("Invalid month '%s'" % (month,))
+            end = start.replace(year=start.year + start.month // 12,
+                                month=start.month % 12 + 1)
+        # Drill-downs are shown from both tiers, like the facet counts
+        include_cold = archived or bool(month) or bool(sender)
+
         mails = [{
             'subject': escape(mail.subject),
             'href': req.href.mailarchive(mail.id),
             'from': render_mailto(mail.fromheader or ''),
             'date': format_datetime(mail.date),
             'comment_html': format_to_html(self.env, context, mail.comment),
-        } for mail in ArchivedMail.select_filtered_paginated(self.env, page, max_per_page, filter)]
-        total_count = ArchivedMail.count_filtered(self.env, filter)
-
+        } for mail in ArchivedMail.select_filtered_paginated(self.env, page, max_per_page, filter, include_cold,
+                                                             start, end, sender)]
+        total_count = ArchivedMail.count_filtered(self.env, filter, include_cold, start, end, sender)
+
+        query = {
+            'max': max_per_page,
+            'filter': filter or None,
+            'archived': 1 if archived else None,
+            'month': month or None,
+            'sender': sender or None,
+        }
         paginator = Paginator(mails, page - 1, max_per_page, total_count)
         if paginator.has_next_page:
-            next_href = req.href.mailarchive(max=max_per_page, page=page + 1)
+            next_href = req.href.mailarchive(page=page + 1, **query)
             add_link(req, 'next', next_href, 'Next Page')
         if paginator.has_previous_page:
-            prev_href = req.href.mailarchive(max=max_per_page, page=page - 1)
+            prev_href = req.href.mailarchive(page=page - 1, **query)
             add_link(req, 'prev', prev_href, 'Previous Page')
 
         pagedata = []
         shown_pages = paginator.get_shown_pages(21)
         for page in shown_pages:
-            pagedata.append([req.href.mailarchive(page=page), None,
+            pagedata.append([req.href.mailarchive(page=page, **query), None,
                              str(page), 'Page %d' % (page,)])
         paginator.shown_pages = [dict(zip(['href', 'class', 'string', 'title'], p)) for p in pagedata]
         paginator.current_page = {'href': None, 'class': 'current',
                                 'string': str(paginator.page + 1),
                                 'title':None}
 
+        for format, mimetype in sorted(EXPORT_FORMATS.items()):
+            add_link(req, 'alternate',
+                     req.href.mailarchive('export', format=format, filter=filter or None),
+                     format, mimetype, format)
+
+        def facet_data(facet, by_count=False, limit=None):
+            return [{
+                'value': value,
+                'count': count,
+                'href': req.href.mailarchive(**dict(query, **{facet: value})),
+                'current': value == query[facet],
+            } for value, count in ArchivedMail.select_facet_counts(self.env, facet, by_count, limit)]
+
         help_html = format_to_html(self.env, context, self.help)
+        add_script(req, 'common/js/folding.js')
 
         data = {
             'mails': mails,
@@ -169,21 +268,30 @@ class MailArchiveModule(Component):
             'max_per_page': max_per_page,
             'help': help_html,
             'filter': filter,
+            'archived': archived,
+            'month': month,
+            'sender': sender,
+            'unfiltered_href': req.href.mailarchive(**dict(query, month=None, sender=None)),
+            'months': facet_data('month'),
+            'senders': facet_data('sender', by_count=True, limit=self.top_senders),
         }
         return "archivedmail-list.html", data
 
     def _render_mail(self, req, id):
-        mail = ArchivedMail.select_by_id(self.env, id)
+        mail = ArchivedMail.select_by_id(self.env, id, with_body=False)
         if not mail:
             raise ResourceNotFound("Mail does not exist")
+        body, more_body = ArchivedMail.select_text_chunk(self.env, id, 'body', 0,
+                                                         self._chunk_size)
+
+        # Look up the thread in the cold tier only when looking at old mail
+        include_cold = mail.archived or bool(req.args.get('archived'))
 
         def mail_data(mail):
             return {
                 'subject': escape(mail.subject),
                 'from': render_mailto(mail.fromheader or ''),
                 'to': render_mailto(mail.toheader or ''),
-                'body': escape(mail.body),
-                'allheaders': escape(mail.allheaders),
                 'date': format_datetime(mail.date),
                 'comment': escape(mail.comment),
                 'ref': req.href.mailarchive(mail.id),
@@ -200,7 +308,7 @@ class MailArchiveModule(Component):
                 if header.startswith(h)
                 for part in header[len(h):].split(' ')
                 if part
-                for found_mail in ArchivedMail.search(self.env, [part.strip()])
+                for found_mail in ArchivedMail.search(self.env, [part.strip()], include_cold=include_cold)
             }.items())
         ]
 
@@ -208,14 +316,19 @@ class MailArchiveModule(Component):
         context = web_context(req, resource)
         data = {
             'mail': mail_data(mail),
+            'body': escape(body),
+            'body_href': req.href.mailarchive(id, 'body'),
+            'body_next_offset': len(body) if more_body else None,
+            'headers_href': req.href.mailarchive(id, 'headers'),
             'related_mails': related_mail_data,
             'attachments': AttachmentModule(self.env).attachment_data(context),
         }
 
-        if ArchivedMail.select_by_id(self.env, id - 1) is not None:
+        neighbours = ArchivedMail.select_existing_ids(self.env, [id - 1, id + 1])
+        if str(id - 1) in neighbours:
             add_link(req, 'prev', req.href.mailarchive(id - 1), 'Prev')
         add_link(req, 'up', req.href.mailarchive(), 'Up')
-        if ArchivedMail.select_by_id(self.env, id + 1) is not None:
+        if str(id + 1) in neighbours:
             add_link(req, 'next', req.href.mailarchive(id + 1), 'Next')
         prevnext_nav(req, 'Prev', 'Next', 'Up')
 
@@ -228,11 +341,13 @@ class MailArchiveModule(Component):
     def get_search_filters(self, req):
         if 'MAIL_ARCHIVE_VIEW' in req.perm:
             yield ('mailarchive', 'Mail Archive', True)
+            yield ('mailarchive-archived', 'Mail Archive (older mail)', False)
 
     def get_search_results(self, req, terms, filters):
-        if not 'mailarchive' in filters:
+        if 'mailarchive' not in filters and 'mailarchive-archived' not in filters:
             return
-        for mail in ArchivedMail.search(self.env, terms):
+        include_cold = 'mailarchive-archived' in filters
+        for mail in ArchivedMail.search(self.env, terms, include_cold=include_cold):
             dt = mail.date
             link = req.href.mailarchive(mail.id)
             title = escape(mail.subject)
@@ -242,6 +357,29 @@ class MailArchiveModule(Component):
             if 'MAIL_ARCHIVE_VIEW' in req.perm(resource):
                 yield (link, title, dt, author, excerpt)
 
+    # ITimelineEventProvider methods
+
+    def get_timeline_filters(self, req):
+        if 'MAIL_ARCHIVE_VIEW' in req.perm:
+            yield ('mailarchive', 'Archived mails')
+
+    def get_timeline_events(self, req, start, stop, filters):
+        if 'mailarchive' not in filters:
+            return
+        for mail in ArchivedMail.select_summaries_between(self.env, start, stop):
+            resource = Resource('mailarchive', mail.id)
+            if 'MAIL_ARCHIVE_VIEW' in req.perm(resource):
+                yield ('mailarchive', mail.date, mail.fromheader, (mail.id, mail.subject))
+
+    def render_timeline_event(self, context, field, event):
+        id, subject = event[3]
+        if field == 'url':
+            return context.href.mailarchive(id)
+        elif field == 'title':
+            return tag('Mail ', tag.em(subject))
+        elif field == 'description':
+            return ''
+
     # ITemplateProvider methods
 
     def get_htdocs_dirs(self):
@@ -278,6 +416,8 @@ class MailQueryMacro(WikiMacroBase):
         format=list
 
     The `max` parameter can be used to limit the number of mails shown (defaults to 0, i.e. no maximum).
+
+    Older mail moved to the cold tier is only included with `archived=true`.
  
     Example:
     {{{
@@ -288,9 +428,10 @@ class MailQueryMacro(WikiMacroBase):
     def expand_macro(self, formatter, name, content):
         args, kw = parse_args(content)
         max = int(kw.get('max', 0))
+        include_cold = kw.get('archived', 'false').lower() in ('true', 'yes', '1')
         terms = args
         items = []
-        for mail in ArchivedMail.search(self.env, terms, max):
+        for mail in ArchivedMail.search(self.env, terms, max, include_cold):
             link = formatter.href.mailarchive(mail.id)
             title = escape(mail.subject)
             comment = format_to_html(self.env, formatter.context, mail.comment)